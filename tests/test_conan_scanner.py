@@ -0,0 +1,101 @@
+import random
+
+from ws_conan_scanner.conan_scanner import assign_source_files_to_last_library, get_package_source_files, get_source_folder_inner_segments, \
+    index_source_files_by_path_segment, parse_conan_profile_values
+
+# 'conan profile show default' of conan 1.66.0
+CONAN_PROFILE_SHOW_OUTPUT = """Configuration for profile default:
+
+[settings]
+os=Linux
+os_build=Linux
+arch=x86_64
+arch_build=x86_64
+compiler=gcc
+compiler.version=12
+compiler.libcxx=libstdc++
+build_type=Release
+[options]
+zlib:shared=True
+[conf]
+tools.build:jobs=8
+[build_requires]
+[env]
+"""
+
+
+def scan_package_source_files(package, source_files):
+    """The original scan of every source file for every package"""
+    return [source_file for source_file in source_files
+            if package['package_full_name'] in source_file['path'] or package['source_folder'] in source_file['path']]
+
+
+def create_package(name, version, source_folder):
+    return {'package_full_name': f"{name}-{version}",
+            'source_folder': source_folder,
+            'source_folder_segments': get_source_folder_inner_segments(source_folder)}
+
+
+def create_source_files(packages, count, rng):
+    templates = ('{root}/{name}-{version}/src/{file}',
+                 '{root}/{name}-{version}.tar.gz/{name}-{version}/{file}',
+                 '{root}/{name}-{version}-src/{file}',
+                 '{root}/third_party/{name}{version}/{file}',
+                 '{root}\\vendor\\{name}-{version}\\{file}',
+                 '{source_folder}/{file}',
+                 '{source_folder}_old/{file}',
+                 '{root}/{name}/{version}/{file}')
+    source_files = []
+    for i in range(count):
+        package = rng.choice(packages)
+        name, _, version = package['package_full_name'].partition('-')
+        version = rng.choice((version, version[:-1], version + '1'))
+        path = rng.choice(templates).format(root=rng.choice(('C:\\work', '/home/user/project', 'build')), name=name, version=version,
+                                            source_folder=package['source_folder'], file=f"file_{i}.c")
+        source_files.append({'path': path, 'sha1': str(i)})
+    return source_files
+
+
+def test_get_package_source_files_matches_full_scan():
+    rng = random.Random(0)
+    packages = []
+    for name in ('zlib', 'openssl', 'bzip2', 'libcurl', 'zstd', 'boost', 'fmt', 'spdlog', 'gtest', 'expat'):
+        for version in ('1.2.1', '1.2.11', '3.0.2'):
+            source_folder = rng.choice((f"/home/user/.conan/data/{name}/{version}/_/_/source",
+                                        f"C:\\.conan\\data\\{name}\\{version}\\_\\_\\source",
+                                        "source"))  # no inner segment - every source file is checked
+            packages.append(create_package(name, version, source_folder))
+    source_files = create_source_files(packages, 3000, rng)
+    source_files_index = index_source_files_by_path_segment(source_files)
+
+    for package in packages:
+        assert get_package_source_files(package, source_files, source_files_index) == scan_package_source_files(package, source_files)
+
+
+def test_assign_source_files_to_last_library_keeps_a_shared_sha1_under_the_last_library():
+    libraries_sha1s = {'uuid-a': ['sha1-1', 'sha1-2'], 'uuid-b': ['sha1-2', 'sha1-3']}
+
+    assert assign_source_files_to_last_library(libraries_sha1s) == {'uuid-a': ['sha1-1'], 'uuid-b': ['sha1-2', 'sha1-3']}
+
+
+def test_assign_source_files_to_last_library_drops_a_library_left_without_sha1s():
+    libraries_sha1s = {'uuid-a': ['sha1-1', 'sha1-2'], 'uuid-b': ['sha1-3'], 'uuid-c': ['sha1-2', 'sha1-1']}
+
+    assert assign_source_files_to_last_library(libraries_sha1s) == {'uuid-b': ['sha1-3'], 'uuid-c': ['sha1-2', 'sha1-1']}
+
+
+def test_parse_conan_profile_values():
+    assert parse_conan_profile_values(CONAN_PROFILE_SHOW_OUTPUT) == {'os': 'Linux', 'os_build': 'Linux', 'arch': 'x86_64', 'arch_build': 'x86_64', 'compiler': 'gcc',
+                                                                     'compiler.runtime': '', 'compiler.version': '12', 'build_type': 'Release'}
+
+
+def test_parse_conan_profile_values_skips_package_scoped_settings_and_other_sections():
+    output = CONAN_PROFILE_SHOW_OUTPUT.replace('build_type=Release\n', 'build_type=Release\nzlib:compiler=clang\nzlib:build_type=Debug\n')
+    output = output.replace('[conf]\n', '[conf]\nos=Windows\ncompiler.runtime=MT\n')
+
+    profile = parse_conan_profile_values(output)
+    assert (profile['compiler'], profile['build_type'], profile['os'], profile['compiler.runtime']) == ('gcc', 'Release', 'Linux', '')
+
+
+def test_parse_conan_profile_values_maps_missing_settings_to_empty_strings():
+    assert set(parse_conan_profile_values("Configuration for profile empty:\n\n[settings]\n[options]\n").values()) == {''}
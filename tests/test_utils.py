@@ -0,0 +1,99 @@
+import csv
+import io
+
+import orjson
+import pytest
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+from ws_conan_scanner import utils
+
+CSV_URL = 'https://unified-agent.s3.amazonaws.com/conan_index_url_map.csv'
+CSV_BODY = b'conanDownloadUrl,indexDownloadUrl\r\nhttps://zlib.net/zlib-1.2.11.tar.gz,https://index/zlib-1.2.11.tar.gz\r\n'
+CSV_ROWS = [{'conanDownloadUrl': 'https://zlib.net/zlib-1.2.11.tar.gz', 'indexDownloadUrl': 'https://index/zlib-1.2.11.tar.gz'}]
+
+
+def create_response(status_code, body=b'', headers=None):
+    response = Response()
+    response.status_code = status_code
+    response.headers = CaseInsensitiveDict(headers or {})
+    response.raw = io.BytesIO(body)
+    response.url = CSV_URL
+    return response
+
+
+class StubSession:
+    """Returns the given responses in order and records the headers of each request"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests_headers = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests_headers.append(headers)
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def stub_session(monkeypatch):
+    def set_responses(*responses):
+        session = StubSession(*responses)
+        monkeypatch.setattr(utils, 'http_session', session)
+        return session
+
+    return set_responses
+
+
+def test_first_fetch_parses_and_caches_the_rows(stub_session, tmp_path):
+    session = stub_session(create_response(200, CSV_BODY, {'Content-Type': 'text/csv', 'ETag': '"v1"'}))
+
+    assert utils.cached_csv_to_json(CSV_URL, tmp_path) == CSV_ROWS
+    assert session.requests_headers == [{}]
+    assert sorted(path.suffix for path in tmp_path.iterdir()) == ['.json', '.meta']
+
+
+def test_not_modified_returns_the_cached_rows(stub_session, tmp_path):
+    stub_session(create_response(200, CSV_BODY, {'ETag': '"v1"', 'Last-Modified': 'Thu, 15 Oct 2026 08:00:00 GMT'}))
+    utils.cached_csv_to_json(CSV_URL, tmp_path)
+
+    session = stub_session(create_response(304))
+    assert utils.cached_csv_to_json(CSV_URL, tmp_path) == CSV_ROWS
+    assert session.requests_headers == [{'If-None-Match': '"v1"', 'If-Modified-Since': 'Thu, 15 Oct 2026 08:00:00 GMT'}]
+
+
+def test_error_with_a_cache_returns_the_cached_rows(stub_session, tmp_path):
+    stub_session(create_response(200, CSV_BODY, {'ETag': '"v1"'}))
+    utils.cached_csv_to_json(CSV_URL, tmp_path)
+
+    stub_session(create_response(503, b'<Error>SlowDown</Error>'))
+    assert utils.cached_csv_to_json(CSV_URL, tmp_path) == CSV_ROWS
+
+
+def test_error_without_a_cache_returns_no_rows_and_caches_nothing(stub_session, tmp_path):
+    stub_session(create_response(403, b'<Error>AccessDenied</Error>', {'ETag': '"error"'}))
+
+    assert utils.cached_csv_to_json(CSV_URL, tmp_path) == []
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_corrupt_cache_is_a_miss(stub_session, tmp_path):
+    stub_session(create_response(200, CSV_BODY, {'ETag': '"v1"'}))
+    utils.cached_csv_to_json(CSV_URL, tmp_path)
+    cache_file = next(tmp_path.glob('*.json'))
+    cache_file.write_bytes(cache_file.read_bytes()[:10])  # as left by a run killed while writing it
+
+    session = stub_session(create_response(200, CSV_BODY, {'ETag': '"v1"'}))
+    assert utils.cached_csv_to_json(CSV_URL, tmp_path) == CSV_ROWS
+    assert session.requests_headers == [{}]  # no conditional GET , so the server can not answer 304
+    assert orjson.loads(cache_file.read_bytes()) == CSV_ROWS
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, utils.CSV_CHUNK_SIZE])
+def test_streamed_rows_match_a_whole_body_parse(stub_session, tmp_path, monkeypatch, chunk_size):
+    body = 'name,notes\r\nzlib,"multi\nline"\r\nbzip2,"tab\x0bfeed\x0cgroup\x1dnel\x85sep end"\r\nü,"crlf\r\ninside"\r\nlast,no newline'.encode()
+    monkeypatch.setattr(utils, 'CSV_CHUNK_SIZE', chunk_size)  # split lines , \r\n pairs and utf8 characters across chunks
+    stub_session(create_response(200, body, {'Content-Type': 'text/csv'}))
+
+    expected = list(csv.DictReader(io.StringIO(body.decode('utf8'), newline='')))
+    assert utils.cached_csv_to_json(CSV_URL, tmp_path) == expected
+    assert expected[0]['notes'] == 'multi\nline'
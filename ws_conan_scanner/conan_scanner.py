@@ -1,18 +1,21 @@
 import argparse
-import glob
 
 import gc
-import json
 import os
 import pathlib
+import random
+import re
 import shutil
 import subprocess
 import sys
 import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 
+import orjson
 import requests
 import urllib3
 import ws_sdk
@@ -20,8 +23,8 @@ import yaml
 from ws_sdk.ws_constants import UAArchiveFiles
 
 from ws_sdk.ws_utilities import convert_dict_list_to_dict, PathType
-from ws_conan_scanner._version import __tool_name__, __version__, __description__
-from ws_conan_scanner.utils import csv_to_json, str2bool, create_logger, execute_command
+from ws_conan_scanner._version import __version__, __description__
+from ws_conan_scanner.utils import cached_csv_to_json, str2bool, create_logger, execute_command
 
 # Config file variables
 DEFAULT_CONFIG_FILE = 'params.config'
@@ -62,10 +65,22 @@ PROJECT_PARALLELISM_LEVEL_RANGE = list(range(1, PROJECT_PARALLELISM_LEVEL_MAX_VA
 CONAN_FILE_TXT = 'conanfile.txt'
 CONAN_FILE_PY = 'conanfile.py'
 TEMP_FOLDER_PREFIX = 'conan_scanner_pre_process_'
+TOOL_DETAILS_NAME = 'ps-conan-scanner'
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+SCAN_STATUS_POLL_INITIAL_DELAY = 1.0
+SCAN_STATUS_POLL_MAX_DELAY = 30.0
 DATE_TIME_NOW = datetime.now().strftime('%Y%m%d%H%M%S%f')
+PATH_SEPARATORS = re.compile(r'[\\/]')
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)  # LibYAML bindings when PyYAML was built with them
 
 
 class Config:
+    __slots__ = ('project_path', 'unified_agent_path', 'conan_install_folder', 'conan_profile_name', 'resolve_conan_main_package',
+                 'keep_conan_install_folder_after_run', 'include_build_requires_packages', 'conan_run_pre_step', 'change_origin_library',
+                 'ws_url', 'user_key', 'org_token', 'product_token', 'project_token', 'product_name', 'project_name', 'log_file_path',
+                 'date_time_now', 'temp_dir', 'ws_conn', 'ws_conn_details',
+                 'is_conanfilepy', 'directory')  # the last ones are set later in the run
+
     def __init__(self, conf: dict):
         self.project_path = conf.get('project_path')
         self.unified_agent_path = conf.get('unified_agent_path')
@@ -93,38 +108,62 @@ class Config:
         self.ws_conn = ws_sdk.web.WSApp(url=self.ws_url,
                                         user_key=self.user_key,
                                         token=self.org_token,
-                                        tool_details=(f"ps-{__tool_name__.replace('_', '-')}", __version__), timeout=3600)
+                                        tool_details=(TOOL_DETAILS_NAME, __version__), timeout=3600)
 
         logger.info(f"ws connections details:\nwsURL: {self.ws_url}\norgToken: {self.org_token}")
         self.ws_conn_details = self.ws_conn.get_organization_details()
 
 
 def validate_conan_installed():
-    """ Validate conan is installed by retrieving the Conan home directory"""
-    conan_version = execute_command(f"conan --version", logger)
+    """ Validate conan is installed by retrieving the Conan version , from the conans package when it is importable and from the conan cli otherwise"""
+    if shutil.which('conan') is None:  # the later steps run the conan cli , an importable conans package is not enough
+        logger.error("Please check Conan is installed and configured properly - the conan executable was not found on PATH ")
+        sys.exit(1)
+
+    try:
+        from conans import __version__ as conans_version
+        conan_version = f"Conan version {conans_version}"
+    except ImportError:
+        conan_version = execute_command(['conan', '--version'], logger)
 
-    if 'Conan version' in conan_version:
+    if conan_version and 'Conan version' in conan_version:
         logger.info(f"Conan identified - {conan_version} ")
+        return conan_version
     else:
         logger.error(f"Please check Conan is installed and configured properly ")
         sys.exit(1)
 
 
+def parse_conan_profile_values(profile_show_output: str) -> dict:
+    """Maps the settings the scanner uses to their value in the [settings] section of a 'conan profile show' output ( '' when not set ).
+    Package scoped settings ( pkg:setting=value ) are skipped - only the profile wide values are used.
+    """
+    settings = {}
+    section = None
+    for line in profile_show_output.splitlines():
+        line = line.strip()
+        if line.startswith('[') and line.endswith(']'):
+            section = line[1:-1]
+        elif section == 'settings' and '=' in line:
+            key, _, value = line.partition('=')
+            if ':' not in key:
+                settings[key.strip()] = value.strip()
+
+    params = ('os', 'os_build', 'arch', 'arch_build', 'compiler', 'compiler.runtime', 'compiler.version', 'build_type')
+    return {param: settings.get(param, '') for param in params}
+
+
 def map_conan_profile_values(conf):
     global conan_profile
 
     try:
-        subprocess.check_output(f"conan profile show {conf.conan_profile_name}", shell=True, stderr=subprocess.STDOUT).decode()
+        output = subprocess.check_output(['conan', 'profile', 'show', conf.conan_profile_name], stderr=subprocess.STDOUT).decode()
     except subprocess.CalledProcessError as e:
         logger.error(e.output.decode())
         logger.info(f"The conan scanner will stop due to a failure to find the conan profile: {conf.conan_profile_name}")
         sys.exit(1)
 
-    params = ('os', 'os_build', 'arch', 'arch_build', 'compiler', 'compiler.runtime', 'compiler.version', 'build_type')
-    conan_profile = {}
-    for param in params:
-        output = subprocess.Popen(f"conan profile get settings.{param} {conf.conan_profile_name}", shell=True, stdout=subprocess.PIPE, text=True).communicate()[0]
-        conan_profile[param] = ''.join(output.partition('\n')[0:1])
+    conan_profile = parse_conan_profile_values(output)
 
 
 def validate_project_manifest_file_exists(config):
@@ -149,15 +188,13 @@ def map_all_dependencies(config):
         deps_json_file = os.path.join(config.temp_dir, 'deps.json')
         logger.info(f"Mapping project's dependencies to {deps_json_file}")
 
-        if config.include_build_requires_packages:
-            output = execute_command(f"conan info {config.project_path} --paths --dry-build --json {deps_json_file}", logger)
-        else:
-            output = execute_command(f"conan info {config.project_path} --paths --json {deps_json_file}", logger)
+        dry_build = ['--dry-build'] if config.include_build_requires_packages else []
+        output = execute_command(['conan', 'info', config.project_path, '--paths', *dry_build, '--json', deps_json_file], logger)
 
         logger.info(f'\n{output}')  # Todo add print of deps.json
 
-        with open(deps_json_file, encoding='utf-8') as f:
-            deps_data = json.load(f)
+        with open(deps_json_file, 'rb') as f:
+            deps_data = orjson.loads(f.read())
         output_json = [x for x in deps_data if x.get('revision') is not None]  # filter items which have the revision tag
         return output_json
     except subprocess.CalledProcessError as e:
@@ -170,16 +207,26 @@ def run_conan_install_command(config):
     """ Allocate the scanned project dependencies in the conanInstallFolder"""
     try:
         logger.info(f"conanRunPreStep is set to {config.conan_run_pre_step} - will run 'conan install --build' command.")
-        execute_command(f"conan install {config.project_path} --install-folder {config.temp_dir} --build", logger)
+        execute_command(['conan', 'install', config.project_path, '--install-folder', config.temp_dir, '--build'], logger)
         logger.info(f"conan install --build completed , install folder : {config.temp_dir}")
     except subprocess.CalledProcessError as e:
         logger.error(e.output.decode())
 
 
 def conan_cache_packages_source_folder_missing(conan_dependencies: list):
+    # List each parent folder once instead of probing every source folder separately
+    parents_listing = {}
+    for item in conan_dependencies:
+        parent = os.path.dirname(item.get('source_folder'))
+        if parent not in parents_listing:
+            try:
+                parents_listing[parent] = set(os.listdir(parent))
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                parents_listing[parent] = set()
+
     missing_source = []
     for item in conan_dependencies:
-        if os.path.exists(item.get('source_folder')):
+        if os.path.basename(item.get('source_folder')) in parents_listing[os.path.dirname(item.get('source_folder'))]:
             logger.info(f"Source folder exists for {item.get('reference')} at: {item.get('source_folder')}")
         else:
             logger.info(f"Source folder missing for {item.get('reference')} at: {item.get('source_folder')}")
@@ -197,59 +244,78 @@ def get_dependencies_from_download_source(config, source_folders_missing, conan_
     logger.info(f"The following packages source files are missing from the conan cache - will try to extract to {config.directory} :\n{temp}")
     dependencies_list_dict = convert_dict_list_to_dict(lst=conan_dependencies, key_desc='reference')
 
-    packages_list = []
+    def get_dependency_source(item, package_directory):
+        """Runs conan install / conan source for a single package , falls back to downloading the url from conandata.yml
+        :return: a tuple (item, package_directory or None, conandata.yml path or None)
+        """
+        export_folder = dependencies_list_dict[item].get('export_folder')
+        dependency_conan_data_yml = os.path.join(export_folder, 'conandata.yml')  # Check for conandata.yml file
+        package_conan_data_yml = os.path.join(package_directory, 'conandata.yml')
+        try:
+            export_folder_files = {entry.name for entry in os.scandir(export_folder) if entry.is_file()}
+        except OSError:
+            export_folder_files = set()
+
+        if 'conanfile.py' not in export_folder_files:
+            return item, None, None
+
+        install_version = dependencies_list_dict.get(item).get('reference')
+        if '@' not in install_version:
+            install_version = install_version + '@'
+        conan_install_command = ['conan', 'install', '--install-folder', package_directory, export_folder, install_version]
+        conan_source_command = ['conan', 'source', '--source-folder', package_directory, '--install-folder', package_directory, export_folder]
+
+        try:
+            logger.info(f"Going to run the following command : {' '.join(conan_install_command)}")
+            execute_command(conan_install_command, logger, log_prefix=item)
 
+            logger.info(f"Going to run the following command : {' '.join(conan_source_command)}")
+            execute_command(conan_source_command, logger, log_prefix=item)
+
+            return item, package_directory, package_conan_data_yml
+        except subprocess.CalledProcessError as e:
+            logger.error(e.output.decode())
+
+            if os.path.isfile(package_conan_data_yml):
+                logger.info(f"Will try to get source from {package_conan_data_yml} ")
+                package_directory_returned = download_source_package(package_conan_data_yml, package_directory, item)
+                return item, package_directory_returned, package_conan_data_yml
+
+            elif 'conandata.yml' in export_folder_files:
+                logger.info(f"Will try to get source from {dependency_conan_data_yml} ")
+                package_directory_returned = download_source_package(dependency_conan_data_yml, package_directory, item)
+                return item, package_directory_returned, dependency_conan_data_yml
+
+            elif 'conanfile.py' in export_folder_files:  # creates conandata.yml from conanfile.py
+                logger.info(f"{item} conandata.yml is missing from {export_folder} - will try to get with conan source command")
+                try:
+                    logger.info(f"Going to run the following command : {' '.join(conan_source_command)}")
+                    execute_command(conan_source_command, logger, log_prefix=item)
+                    package_directory_returned = download_source_package(package_directory, package_directory, item)
+                    return item, package_directory_returned, package_conan_data_yml
+                except subprocess.CalledProcessError as e:
+                    logger.error(e.output.decode())
+
+            else:
+                logger.warning(f"{item} source files were not found")
+
+        return item, None, None
+
+    # Directories are created up front ( one per package ) so the workers never race on mkdir.
+    packages_directories = {}
     for item in source_folders_missing:
-        export_folder = dependencies_list_dict[item].get('export_folder')
         package_directory = os.path.join(config.directory, item.split('/')[0] + '-' + item.split('/')[1])  # replace  '/' with '-' to align with whitesource convention .
         pathlib.Path(package_directory).mkdir(parents=True, exist_ok=False)
+        packages_directories[item] = package_directory
 
-        dependency_conan_data_yml = os.path.join(export_folder, 'conandata.yml')  # Check for conandata.yml file
-
-        if os.path.isfile(os.path.join(export_folder, 'conanfile.py')):
-            install_version = dependencies_list_dict.get(item).get('reference')
-            if '@' not in install_version:
-                install_version = install_version + '@'
-            conan_install_command = f"conan install --install-folder {package_directory} {export_folder} {install_version}"
-            conan_source_command = f"conan source --source-folder {package_directory} --install-folder {package_directory} {export_folder}"
-
-            try:
-                logger.info(f"Going to run the following command : {conan_install_command}")
-                execute_command(conan_install_command, logger)
-
-                logger.info(f"Going to run the following command : {conan_source_command}")
-                execute_command(conan_source_command, logger)
-
-                packages_list.append(package_directory)
-                dependencies_list_dict.get(item)['conandata_yml'] = os.path.join(package_directory, 'conandata.yml')
-            except subprocess.CalledProcessError as e:
-                logger.error(e.output.decode())
-
-                if os.path.isfile(os.path.join(package_directory, 'conandata.yml')):
-                    logger.info(f"Will try to get source from {os.path.join(package_directory, 'conandata.yml')} ")
-                    package_directory_returned = download_source_package(os.path.join(package_directory, 'conandata.yml'), package_directory, item)
-                    packages_list.append(package_directory_returned)
-                    dependencies_list_dict.get(item)['conandata_yml'] = os.path.join(package_directory, 'conandata.yml')
-
-                elif os.path.isfile(dependency_conan_data_yml):
-                    logger.info(f"Will try to get source from {dependency_conan_data_yml} ")
-                    package_directory_returned = download_source_package(dependency_conan_data_yml, package_directory, item)
-                    packages_list.append(package_directory_returned)
-                    dependencies_list_dict.get(item)['conandata_yml'] = dependency_conan_data_yml
-
-                elif os.path.isfile(os.path.join(export_folder, 'conanfile.py')):  # creates conandata.yml from conanfile.py
-                    logger.info(f"{item} conandata.yml is missing from {export_folder} - will try to get with conan source command")
-                    try:
-                        logger.info(f"Going to run the following command : {conan_source_command}")
-                        execute_command(conan_source_command, logger)
-                        package_directory_returned = download_source_package(package_directory, package_directory, item)
-                        packages_list.append(package_directory_returned)
-                        dependencies_list_dict.get(item)['conandata_yml'] = os.path.join(package_directory, 'conandata.yml')
-                    except subprocess.CalledProcessError as e:
-                        logger.error(e.output.decode())
+    packages_list = []
+    with ThreadPoolExecutor(max_workers=min(PROJECT_PARALLELISM_LEVEL_DEFAULT_VALUE, len(source_folders_missing))) as executor:
+        results = executor.map(get_dependency_source, packages_directories.keys(), packages_directories.values())
 
-                else:
-                    logger.warning(f"{item} source files were not found")
+        for item, package_directory_returned, conandata_yml in results:
+            if conandata_yml:
+                packages_list.append(package_directory_returned)
+                dependencies_list_dict.get(item)['conandata_yml'] = conandata_yml
 
     return packages_list  # Todo remove
 
@@ -259,28 +325,41 @@ def download_source_package(source, directory, package_full_name):
     try:
         url = extract_url_from_conan_data_yml(source, package_full_name)
         if url:
-            r = requests.get(url, allow_redirects=True, headers={'Cache-Control': 'no-cache'})
-            with open(os.path.join(directory, os.path.basename(url)), 'wb') as b:
-                b.write(r.content)
-                logger.info(f"{package_full_name} source files were retrieved from {source} and saved at {directory} ")
-                return directory
+            destination = os.path.join(directory, os.path.basename(url))
+            partial_destination = destination + '.part'  # renamed only once complete , so a broken download is never scanned
+            try:
+                with requests.get(url, allow_redirects=True, headers={'Cache-Control': 'no-cache'}, stream=True, timeout=60) as r:
+                    r.raise_for_status()  # an error page is not the archive
+                    with open(partial_destination, 'wb') as b:
+                        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            b.write(chunk)
+                    expected_length = r.headers.get('Content-Length')
+                    if expected_length and expected_length.isdigit() and r.raw.tell() != int(expected_length):  # urllib3 1.x does not check the body length
+                        raise requests.exceptions.ChunkedEncodingError(f"Connection closed after {r.raw.tell()} of {expected_length} bytes")
+                os.replace(partial_destination, destination)
+            finally:
+                if os.path.exists(partial_destination):
+                    os.remove(partial_destination)
+            logger.info(f"{package_full_name} source files were retrieved from {source} and saved at {directory} ")
+            return directory
     except urllib3.exceptions.ProtocolError as e:
-        logger.error(f'{general_text}\nGeneral requests error: ' + str(e.__traceback__))
+        logger.error(f'{general_text}\nGeneral requests error: ' + str(e))
     except requests.exceptions.ConnectionError as e:
-        logger.error(f'{general_text}\nGeneral requests error: ' + e.response.text)
+        logger.error(f'{general_text}\nGeneral requests error: ' + str(e))
     except (FileNotFoundError, PermissionError, IsADirectoryError) as e:
-        logger.warning(f"{general_text} as conandata.yml was not found or is not accessible: " + e.response.text)
+        logger.warning(f"{general_text} as conandata.yml was not found or is not accessible: " + str(e))
     except requests.exceptions.URLRequired as e:
-        logger.error(f'{general_text}\nThe url retrieved from conandata.yml is missing: ' + e.response.text)
+        logger.error(f'{general_text}\nThe url retrieved from conandata.yml is missing: ' + str(e))
     except requests.exceptions.InvalidURL as e:
-        logger.error(f'{general_text}\nThe url retrieved from conandata.yml is Invalid: ' + e.response.text)
+        logger.error(f'{general_text}\nThe url retrieved from conandata.yml is Invalid: ' + str(e))
     except requests.exceptions.Timeout as e:
-        logger.error(f'{general_text}\nGot requests Timeout: ' + e.response.text)
+        logger.error(f'{general_text}\nGot requests Timeout: ' + str(e))
     except requests.exceptions.RequestException as e:
-        logger.error(f'{general_text}\nGeneral requests error: ' + e.response.text)
+        logger.error(f'{general_text}\nGeneral requests error: ' + str(e))
 
 
 def get_source_folders_list(source_folders_missing, conan_dependencies: list):
+    source_folders_missing = frozenset(source_folders_missing)
     source_folder_libs = []
     for item in conan_dependencies:
         if item.get('reference') not in source_folders_missing:
@@ -299,7 +378,9 @@ def scan_with_unified_agent(config, dirs_to_scan):
 
     ws_exclude_hardcoded = "**/ws_conan_scanned_*,jna-1649909383"
     ws_excludes_default = "**/*conan_export.tgz,**/*conan_package.tgz,**/*conanfile.py,**/node_modules,**/src/test,**/testdata,**/*sources.jar,**/*javadoc.jar"
-    os.environ['WS_EXCLUDES'] = os.environ.get('WS_EXCLUDES') + ',' + ws_exclude_hardcoded if os.environ.get('WS_EXCLUDES') is not None else os.environ.get('WS_EXCLUDES', '') + ws_exclude_hardcoded + ',' + ws_excludes_default
+    ws_excludes = os.environ.get('WS_EXCLUDES')
+    excludes = [ws_excludes, ws_exclude_hardcoded] if ws_excludes is not None else [ws_exclude_hardcoded, ws_excludes_default]
+    os.environ['WS_EXCLUDES'] = ','.join(filter(None, excludes))
 
     unified_agent.ua_conf.archiveExtractionDepth = str(UAArchiveFiles.ARCHIVE_EXTRACTION_DEPTH_MAX)
     unified_agent.ua_conf.archiveIncludes = list(UAArchiveFiles.ALL_ARCHIVE_FILES)
@@ -315,6 +396,7 @@ def scan_with_unified_agent(config, dirs_to_scan):
     support_token = output[2]  # gets Support Token from scan output
 
     scan_status = True
+    delay = SCAN_STATUS_POLL_INITIAL_DELAY
     while scan_status:
         new_status = config.ws_conn.get_last_scan_process_status(support_token)
         logger.info(f"Scan data upload status :{new_status}")
@@ -325,7 +407,8 @@ def scan_with_unified_agent(config, dirs_to_scan):
             logger.warning('scan failed to upload...exiting program')
             sys.exit(1)
         else:
-            time.sleep(20.0)
+            time.sleep(delay * random.uniform(0.75, 1.25))  # exponential backoff with +-25% jitter
+            delay = min(delay * 1.5, SCAN_STATUS_POLL_MAX_DELAY)
 
 
 def update_conandta_yml_download_url_from_ws_index(config, conan_dependencies):
@@ -343,7 +426,8 @@ def update_conandta_yml_download_url_from_ws_index(config, conan_dependencies):
             pass
         return response.get('keyUuid')
 
-    index_download_links = convert_dict_list_to_dict(lst=csv_to_json('https://unified-agent.s3.amazonaws.com/conan_index_url_map.csv'), key_desc='conanDownloadUrl')
+    index_download_links = convert_dict_list_to_dict(lst=cached_csv_to_json('https://unified-agent.s3.amazonaws.com/conan_index_url_map.csv'), key_desc='conanDownloadUrl')
+    load_conan_data_ymls({package.get('conandata_yml') for package in conan_dependencies if package.get('conandata_yml')})
     for package in conan_dependencies:
         package['counter'] = 0  # done in favor of next step.
         source = package.get('conandata_yml')
@@ -371,6 +455,49 @@ def get_project_inventory_dict_by_download_link(due_diligence: dict, inventory):
     return convert_dict_list_to_dict(lst=inventory, key_desc='download_link')
 
 
+def index_source_files_by_path_segment(source_files: list) -> dict:
+    """Maps each path segment to the ordered positions of the source files whose path contains it"""
+    index = defaultdict(list)
+    for position, source_file in enumerate(source_files):
+        for segment in set(PATH_SEPARATORS.split(source_file['path'])):
+            index[segment].append(position)
+    return index
+
+
+def assign_source_files_to_last_library(libraries_key_uuid_and_source_files_sha1: dict) -> dict:
+    """A sha1 can be listed under several libraries - keeps it only under the last one ( the library it ended in when the changes ran one after the other ).
+    Libraries left without sha1s are dropped.
+    """
+    last_key_uuid_by_sha1 = {sha1: key_uuid for key_uuid, sha1s in libraries_key_uuid_and_source_files_sha1.items() for sha1 in sha1s}
+    libraries_sha1s = {key_uuid: [sha1 for sha1 in sha1s if last_key_uuid_by_sha1[sha1] == key_uuid]
+                       for key_uuid, sha1s in libraries_key_uuid_and_source_files_sha1.items()}
+    return {key_uuid: sha1s for key_uuid, sha1s in libraries_sha1s.items() if sha1s}
+
+
+def get_source_folder_inner_segments(source_folder) -> list:
+    """Inner segments of a source folder are always whole segments of a path containing it"""
+    return [segment for segment in PATH_SEPARATORS.split(source_folder)[1:-1] if segment]
+
+
+def get_package_source_files(package, source_files: list, source_files_index: dict) -> list:
+    """Returns the source files whose path contains the package full name or its source folder.
+    The package name is still compared with every distinct path segment ( each file basename is one , so there are about as many segments as files ) ,
+    but only the files of the matching segments and of the rarest inner source folder segment are then checked against the full condition.
+    """
+    package_full_name = package['package_full_name']
+    folder_segments = package['source_folder_segments']
+    if not folder_segments or PATH_SEPARATORS.search(package_full_name):  # no whole segment to look up
+        candidates = range(len(source_files))
+    else:
+        candidates = set(min((source_files_index.get(segment, ()) for segment in folder_segments), key=len))
+        for segment, positions in source_files_index.items():
+            if package_full_name in segment:
+                candidates.update(positions)
+
+    return [source_files[position] for position in sorted(candidates)
+            if package_full_name in source_files[position]['path'] or package['source_folder'] in source_files[position]['path']]
+
+
 def change_project_source_file_inventory_match(config, conan_dependencies_new):
     """changes source files mapping with changeOriginLibrary API"""
 
@@ -383,7 +510,7 @@ def change_project_source_file_inventory_match(config, conan_dependencies_new):
         if not config.project_token:
             projects_tokens = conf.ws_conn.get_scopes_from_name(conf.project_name, token_type='project')
             project_tokens_dict = convert_dict_list_to_dict(lst=projects_tokens, key_desc='product_token')
-            proj_token = project_tokens_dict.get(prod_token).get('token')
+            proj_token = project_tokens_dict[prod_token]['token']
         else:
             proj_token = conf.project_token
         return proj_token
@@ -391,8 +518,7 @@ def change_project_source_file_inventory_match(config, conan_dependencies_new):
     def process_project_due_diligence_report(conf, project_tok):
         project_due_diligence = conf.ws_conn.get_due_diligence(token=project_tok, report=False)
         for lib in project_due_diligence:
-            if lib['library'][len(lib['library']) - 1] == '*':  # Remove astrix from the end of library name (occurs when licences number >1 )
-                lib['library'] = lib['library'][:-1]
+            lib['library'] = lib['library'].rstrip('*')  # Remove astrix from the end of library name (occurs when licences number >1 )
 
         return convert_dict_list_to_dict(project_due_diligence, key_desc='library')
 
@@ -402,7 +528,7 @@ def change_project_source_file_inventory_match(config, conan_dependencies_new):
             if 'Unmatched Source Files' not in source_file['library']['artifactId']:
                 source_file['sc_counter'] = 0  # Debug
                 source_file['source_lib_full_name'] = source_file['library']['artifactId'] + '-' + source_file['library']['version']
-                source_file['download_link'] = due_diligence_dict.get(source_file['source_lib_full_name']).get('download_link')
+                source_file['download_link'] = due_diligence_dict[source_file['source_lib_full_name']].get('download_link')
             else:
                 source_file['sc_counter'] = 0  # Debug
                 source_file['source_lib_full_name'] = source_file['library']['artifactId'] + '-' + source_file['library']['version']
@@ -415,34 +541,33 @@ def change_project_source_file_inventory_match(config, conan_dependencies_new):
 
         missing_sf_counter_is_index_key_uuid = 0
         missing_sf_counter_is_not_index_key_uuid = 0
+        source_files_index = index_source_files_by_path_segment(project_source_files_inventory_to_remap_first_phase)
         for package in conan_dependencies_new:
-            for source_file in project_source_files_inventory_to_remap_first_phase:
-                if package['package_full_name'] in source_file['path'] or package['source_folder'] in source_file['path']:
-                    if source_file.get('download_link') is not None and source_file.get('download_link') in str(project_inventory_dict_by_download_link.get(package['conandata_yml_download_url'])):
-                        package['counter'] += 1
-                        source_file['accurate_match'] = True
-                    elif package.get('key_uuid'):
-                        source_file['need_to_remap'] = True
-                        libraries_key_uuid_and_source_files_sha1[json.dumps(package['key_uuid'])].append(source_file['sha1'])
-                        missing_sf_counter_is_index_key_uuid += 1
-                    else:
-                        source_file['sc_counter'] += 1
-                        project_source_files_inventory_to_remap_second_phase.append(source_file)
-                        missing_sf_counter_is_not_index_key_uuid += 1
+            package_library = str(project_inventory_dict_by_download_link.get(package['conandata_yml_download_url']))  # joined once per package , not per source file
+            for source_file in get_package_source_files(package, project_source_files_inventory_to_remap_first_phase, source_files_index):
+                if source_file.get('download_link') is not None and source_file.get('download_link') in package_library:
+                    package['counter'] += 1
+                    source_file['accurate_match'] = True
+                elif package.get('key_uuid'):
+                    source_file['need_to_remap'] = True
+                    libraries_key_uuid_and_source_files_sha1[package['key_uuid']].append(source_file['sha1'])
+                    missing_sf_counter_is_index_key_uuid += 1
+                else:
+                    source_file['sc_counter'] += 1
+                    project_source_files_inventory_to_remap_second_phase.append(source_file)
+                    missing_sf_counter_is_not_index_key_uuid += 1
             if package['counter'] > 0:
-                logger.info(f"for {package['package_full_name']} conan package: {package['counter']} source files are mapped to the correct library ({project_inventory_dict_by_download_link.get(package['conandata_yml_download_url'])['filename']}) in {org_name}")
+                logger.info("for %s conan package: %s source files are mapped to the correct library (%s) in %s", package['package_full_name'], package['counter'], project_inventory_dict_by_download_link.get(package['conandata_yml_download_url'])['filename'], org_name)
             else:
-                logger.info(f"for {package['package_full_name']} conan package: {package['counter']} source files are mapped to the correct library in {org_name}")
+                logger.info("for %s conan package: %s source files are mapped to the correct library in %s", package['package_full_name'], package['counter'], org_name)
         missing_sf_counter = missing_sf_counter_is_index_key_uuid + missing_sf_counter_is_not_index_key_uuid
         logger.info(f"There are {missing_sf_counter} source files that can be re-mapped to the correct conan source library in {org_name}")
         return project_source_files_inventory_to_remap_second_phase, libraries_key_uuid_and_source_files_sha1
 
-    def project_source_files_remap_first_phase(conf, libraries_key_uuid_and_source_files_sha1, project_token, org_name):
+    def project_source_files_remap_first_phase(conf, libraries_key_uuid_and_source_files_sha1, project_token, org_name, project_inventory_dict_by_key_uuid):
         from ws_sdk.ws_errors import WsSdkClientGenericError
 
-        sha_ones_count = 0
-        for key_uuid, sha1s in libraries_key_uuid_and_source_files_sha1.items():
-            key_uuid = key_uuid.strip('"')
+        def change_origin(key_uuid, sha1s):
             try:
                 conf.ws_conn.change_origin_of_source_lib(lib_uuid=key_uuid,
                                                          source_files_sha1=sha1s,
@@ -450,9 +575,21 @@ def change_project_source_file_inventory_match(config, conan_dependencies_new):
             except ws_sdk.ws_errors.WsSdkServerGenericError as e:
                 # logger.warning(e)
                 pass
+
+        # the parallel changes never compete on a source file
+        libraries_key_uuid_and_source_files_sha1 = assign_source_files_to_last_library(libraries_key_uuid_and_source_files_sha1)
+
+        with ThreadPoolExecutor(max_workers=min(PROJECT_PARALLELISM_LEVEL_DEFAULT_VALUE, len(libraries_key_uuid_and_source_files_sha1))) as executor:
+            list(executor.map(change_origin, libraries_key_uuid_and_source_files_sha1.keys(), libraries_key_uuid_and_source_files_sha1.values()))
+
+        # Reuse the inventory fetched by the caller , it is refetched ( once ) only when a target library was not part of the project before the change.
+        if any(key_uuid not in project_inventory_dict_by_key_uuid for key_uuid in libraries_key_uuid_and_source_files_sha1):
             project_inventory_updated = conf.ws_conn.get_inventory(token=project_token, with_dependencies=True, report=False)
             project_inventory_dict_by_key_uuid = convert_dict_list_to_dict(lst=project_inventory_updated, key_desc='keyUuid')
-            logger.info(f"--{len(sha1s)} source files were moved to {project_inventory_dict_by_key_uuid.get(key_uuid).get('filename')} library in {org_name}")
+
+        sha_ones_count = 0
+        for key_uuid, sha1s in libraries_key_uuid_and_source_files_sha1.items():
+            logger.info("--%s source files were moved to %s library in %s", len(sha1s), project_inventory_dict_by_key_uuid[key_uuid]['filename'], org_name)
             sha_ones_count += len(sha1s)
 
         logger.info(f"Total {sha_ones_count} source files were remapped to the correct libraries.")
@@ -472,11 +609,11 @@ def change_project_source_file_inventory_match(config, conan_dependencies_new):
     def get_packages_source_files_from_inventory_scan_results(project_source_files_inventory_to_remap_third_phase, conan_dependencies_new):
         packages_and_source_files_sha1 = defaultdict(list)
 
+        source_files_index = index_source_files_by_path_segment(project_source_files_inventory_to_remap_third_phase)
         for package in conan_dependencies_new:
-            for source_file in project_source_files_inventory_to_remap_third_phase:
-                if package['package_full_name'] in source_file['path'] or package['source_folder'] in source_file['path']:
-                    source_file['download_link'] = package.get('conandata_yml_download_url')  # Todo check if can be removed
-                    packages_and_source_files_sha1[json.dumps(package['package_full_name'])].append(source_file['sha1'])
+            for source_file in get_package_source_files(package, project_source_files_inventory_to_remap_third_phase, source_files_index):
+                source_file['download_link'] = package.get('conandata_yml_download_url')  # Todo check if can be removed
+                packages_and_source_files_sha1[package['package_full_name']].append(source_file['sha1'])
 
         return packages_and_source_files_sha1
 
@@ -496,15 +633,19 @@ def change_project_source_file_inventory_match(config, conan_dependencies_new):
     # get project inventory as it contain the keyUuid to be used later on
     project_inventory = config.ws_conn.get_inventory(token=project_token, with_dependencies=True, report=False)
     project_inventory_dict_by_download_link = get_project_inventory_dict_by_download_link(due_diligence=project_due_diligence_dict_by_library_name, inventory=project_inventory)
+    project_inventory_dict_by_key_uuid = convert_dict_list_to_dict(lst=project_inventory, key_desc='keyUuid')
 
     for package in conan_dependencies_new:
-        package.update({'package_full_name': package.get('reference').replace('/', '-'),
-                        'name': package.get('reference').partition('/')[0],
-                        'version': package.get('reference').partition('/')[2]})
+        reference = package.get('reference')
+        name, _, version = reference.partition('/')
+        package.update({'package_full_name': reference.replace('/', '-'),
+                        'name': name,
+                        'version': version,
+                        'source_folder_segments': get_source_folder_inner_segments(package['source_folder'])})
 
     project_source_files_inventory_to_remap_second_phase, libraries_key_uuid_and_source_files_sha1 = get_project_source_files_inventory_to_remap(conan_dependencies_new, project_source_files_inventory, project_inventory_dict_by_download_link, org_name)
     if len(libraries_key_uuid_and_source_files_sha1) > 0:
-        project_source_files_remap_first_phase(config, libraries_key_uuid_and_source_files_sha1, project_token, org_name)
+        project_source_files_remap_first_phase(config, libraries_key_uuid_and_source_files_sha1, project_token, org_name, project_inventory_dict_by_key_uuid)
 
     if len(project_source_files_inventory_to_remap_second_phase) > 0:
         project_source_files_inventory_to_remap_third_phase = get_project_source_files_inventory_to_remap_third_phase(project_source_files_inventory_to_remap_second_phase)
@@ -515,94 +656,115 @@ def change_project_source_file_inventory_match(config, conan_dependencies_new):
         # Changing mis-mapped source files to optional library based on conan download url with global search
         counter = 0
         packages_dict_by_package_full_name = convert_dict_list_to_dict(lst=conan_dependencies_new, key_desc='package_full_name')
+        project_source_files_inventory_to_remap_third_phase_dict = convert_dict_list_to_dict(lst=project_source_files_inventory_to_remap_third_phase, key_desc='sha1')
+        # Source libraries of the project with their lowered filename , computed once for the name match fallback
+        project_source_libraries = [(library.get('filename').lower(), library) for library in project_inventory if library.get('type') == 'SOURCE_LIBRARY']
 
+        total_remaining_packages = len(remaining_conan_local_packages_and_source_files_sha1)
+        library_search_results_by_name = {}  # packages of the same library ( other versions / profiles ) share one global search
         for package, sha1s in remaining_conan_local_packages_and_source_files_sha1.items():  # Todo - add threads
-            no_match = True
-            package = json.loads(package)
-            if packages_dict_by_package_full_name[package].get('key_uuid'):
-                logger.info(f"found a match for miss configured source files of {package}")
+            package_entry = packages_dict_by_package_full_name[package]
+            if package_entry.get('key_uuid'):
+                logger.info("found a match for miss configured source files of %s", package)
                 try:
-                    config.ws_conn.change_origin_of_source_lib(lib_uuid=packages_dict_by_package_full_name[package]['key_uuid'],
+                    config.ws_conn.change_origin_of_source_lib(lib_uuid=package_entry['key_uuid'],
                                                                source_files_sha1=sha1s,
                                                                user_comments='Source files changed by Whitesource conan scan_' + config.date_time_now)
                 except ws_sdk.ws_errors.WsSdkServerGenericError as e:
                     # logger.warning(e)
                     pass
-                no_match = False
                 counter += 1
-                logger.info(f"--{counter}/{len(remaining_conan_local_packages_and_source_files_sha1)} libraries were matched ( {len(sha1s)} mis-configured source files from {package} conan package were matched to WS source library )")
-            ####
-            else:
-                logger.info(f"Trying match the remaining miss configured source files of {package} with global search")
+                logger.info("--%s/%s libraries were matched ( %s mis-configured source files from %s conan package were matched to WS source library )", counter, total_remaining_packages, len(sha1s), package)
+                continue
+
+            logger.info("Trying match the remaining miss configured source files of %s with global search", package)
+            check_url = package_entry['conandata_yml_download_url']
+            matched_library = None
+            if check_url:  # without a download url there is nothing to compare the search results with
                 library_name = package.partition('-')[0]
-                library_search_result = config.ws_conn.get_libraries(library_name)
-
-                # Filtering results - only for 'Source Library'
-                source_libraries = []
-                for library in library_search_result:
-                    if library['type'] == 'Source Library':
-                        source_libraries.append(library)
-
-                source_libraries_dict_from_search_by_download_link = convert_dict_list_to_dict(source_libraries, key_desc=str('url'))
-                check_url = packages_dict_by_package_full_name[package]['conandata_yml_download_url']
-
-                if source_libraries_dict_from_search_by_download_link.get(check_url):
-                    library_key_uuid = source_libraries_dict_from_search_by_download_link[check_url].get('keyUuid')
-                    logger.info(f"found a match by global search for miss configured source files of {package}")
-                    try:
-                        config.ws_conn.change_origin_of_source_lib(lib_uuid=library_key_uuid,
-                                                                   source_files_sha1=sha1s,
-                                                                   user_comments='Source files changed by Whitesource conan scan_' + config.date_time_now)
-                    except ws_sdk.ws_errors.WsSdkServerGenericError as e:
-                        # logger.warning(e)
-                        pass
-                    no_match = False
-                    counter += 1
-                    logger.info(f"--{counter}/{len(remaining_conan_local_packages_and_source_files_sha1)} libraries were matched ( {len(sha1s)} mis-configured source files from {package} conan package were matched to {source_libraries_dict_from_search_by_download_link[check_url]['filename']} WS source library )")
+                if library_name not in library_search_results_by_name:
+                    library_search_results_by_name[library_name] = config.ws_conn.get_libraries(library_name)
+                library_search_result = library_search_results_by_name[library_name]
+                # Only 'Source Library' results with the package download url - the last one wins , as when they were keyed by url
+                matched_library = next((library for library in reversed(library_search_result)
+                                        if library['type'] == 'Source Library' and library.get('url') == check_url), None)
+
+            if matched_library:
+                library_key_uuid = matched_library['keyUuid']
+                logger.info("found a match by global search for miss configured source files of %s", package)
+                try:
+                    config.ws_conn.change_origin_of_source_lib(lib_uuid=library_key_uuid,
+                                                               source_files_sha1=sha1s,
+                                                               user_comments='Source files changed by Whitesource conan scan_' + config.date_time_now)
+                except ws_sdk.ws_errors.WsSdkServerGenericError as e:
+                    # logger.warning(e)
+                    pass
+                counter += 1
+                logger.info("--%s/%s libraries were matched ( %s mis-configured source files from %s conan package were matched to %s WS source library )", counter, total_remaining_packages, len(sha1s), package, matched_library['filename'])
+                continue
+
+            logger.info("Match was not found by global search for miss configured source files of %s", package)
+            logger.info("Trying match the remaining miss configured source files of %s with name match", package)
+
+            no_match = True
+            # the name followed by the version , compared with the lowered library filename
+            name_version_pattern = re.compile(f"{re.escape(package_entry['name'].lower())}.*{re.escape(package_entry['version'].lower())}")
+
+            for library_filename_lower, library in project_source_libraries:
+                if name_version_pattern.search(library_filename_lower):
+                    library_key_uuid = library['keyUuid']
+                    library_filename = library['filename']
+
+                    already_mapped_sha1s = {sha1 for sha1 in sha1s if project_source_files_inventory_to_remap_third_phase_dict[sha1]['source_lib_full_name'] == library_filename}
+                    sha1s_final = [sha1 for sha1 in sha1s if sha1 not in already_mapped_sha1s]
+                    if already_mapped_sha1s:
+                        logger.info("%s sha1s of %s are already mapped to %s", len(already_mapped_sha1s), package, library_filename)
+                    if len(sha1s_final) > 0:
+                        try:
+                            config.ws_conn.change_origin_of_source_lib(lib_uuid=library_key_uuid,
+                                                                       source_files_sha1=sha1s_final,
+                                                                       user_comments='Source files changed by Whitesource conan scan_' + config.date_time_now)
+                        except ws_sdk.ws_errors.WsSdkServerGenericError as e:
+                            # logger.warning(e)
+                            pass
+                        no_match = False
+                        logger.info("found a match for miss configured source files of %s", package)
+                        counter += 1
+                        logger.info("--%s/%s libraries were matched ( %s mis-configured source files from %s conan package were matched to %s WS source library )", counter, total_remaining_packages, len(sha1s_final), package, library_filename)
+                    else:
+                        no_match = False
+            if no_match:
+                logger.info("Match was not found by name for miss configured source files of %s", package)
+                logger.info("Did not find match for %s package remaining source files.", package)
 
-                else:
-                    logger.info(f"Match was not found by global search for miss configured source files of {package}")
-                    logger.info(f"Trying match the remaining miss configured source files of {package} with name match")
-                    project_source_files_inventory_to_remap_third_phase_dict = convert_dict_list_to_dict(lst=project_source_files_inventory_to_remap_third_phase, key_desc='sha1')
-
-                    for library in project_inventory:
-                        list1 = library.get('filename').lower()
-                        list2 = [packages_dict_by_package_full_name.get(package).get('name'), packages_dict_by_package_full_name.get(package).get('version')]
-                        result = all(elem in list1 for elem in list2)
-
-                        if result and library.get('type') == 'SOURCE_LIBRARY':
-                            library_key_uuid = library.get('keyUuid')
-                            sha1s_final = []
-
-                            for sha1 in sha1s:
-                                if project_source_files_inventory_to_remap_third_phase_dict.get(sha1).get('source_lib_full_name') == library.get('filename'):
-                                    logger.info(f"sha1: {sha1} is already mapped to {library.get('filename')}")
-                                else:
-                                    sha1s_final.append(sha1)
-                            if len(sha1s_final) > 0:
-                                try:
-                                    config.ws_conn.change_origin_of_source_lib(lib_uuid=library_key_uuid,
-                                                                               source_files_sha1=sha1s_final,
-                                                                               user_comments='Source files changed by Whitesource conan scan_' + config.date_time_now)
-                                except ws_sdk.ws_errors.WsSdkServerGenericError as e:
-                                    # logger.warning(e)
-                                    pass
-                                no_match = False
-                                logger.info(f"found a match for miss configured source files of {package}")
-                                counter += 1
-                                logger.info(f"--{counter}/{len(remaining_conan_local_packages_and_source_files_sha1)} libraries were matched ( {len(sha1s_final)} mis-configured source files from {package} conan package were matched to {library.get('filename')} WS source library )")
-                            else:
-                                no_match = False
-                if no_match:
-                    logger.info(f"Match was not found by name for miss configured source files of {package}")
-                    logger.info(f"Did not find match for {package} package remaining source files.")
+
+@lru_cache(maxsize=1024)
+def load_conan_data_yml(source, mtime):
+    """Parse conandata.yml once per file version ( the modification time is part of the cache key )"""
+    with open(source) as a_yaml_file:
+        return yaml.load(a_yaml_file, Loader=YAML_LOADER)
+
+
+def load_conan_data_ymls(sources):
+    """Parse all the given conandata.yml files in one batch , so the per package url extraction is served from the cache"""
+
+    def load(source):
+        try:
+            source = os.path.abspath(source)
+            load_conan_data_yml(source, os.path.getmtime(source))
+        except (OSError, yaml.YAMLError):
+            pass  # reported per package by extract_url_from_conan_data_yml
+
+    if sources:
+        with ThreadPoolExecutor(max_workers=min(PROJECT_PARALLELISM_LEVEL_DEFAULT_VALUE, len(sources))) as executor:
+            list(executor.map(load, sources))
 
 
 def extract_url_from_conan_data_yml(source, package):
     #  https://github.com/conan-io/hooks/pull/269 , https://github.com/jgsogo/conan-center-index/blob/policy/patching-update/docs/conandata_yml_format.md
     try:
-        with open(source) as a_yaml_file:
-            parsed_yaml_file = yaml.load(a_yaml_file, Loader=yaml.FullLoader)
+        source = os.path.abspath(source)  # str or Path , relative or not - one cache entry per file
+        parsed_yaml_file = load_conan_data_yml(source, os.path.getmtime(source))
         temp = parsed_yaml_file.get('sources')
         for key, value in temp.items():
             url = value.get('url')
@@ -620,25 +782,34 @@ def extract_url_from_conan_data_yml(source, package):
 def remove_previous_run_temp_folder(conf):
     """Remove temp folders from previous run of the connan scanner / UA"""
 
-    def remove_folder(folder_path_pattern):
+    def remove_folder(item):
         try:
-            for item in glob.iglob(folder_path_pattern, recursive=True):
-                shutil.rmtree(item)
-                logger.info(f"removed previous run folder : {item}")
+            shutil.rmtree(item)
+            logger.info(f"removed previous run folder : {item}")
         except OSError as e:
             logger.error("Error: %s - %s." % (e.filename, e.strerror))
 
-    prefix_patterns = (str(Path(conf.conan_install_folder, TEMP_FOLDER_PREFIX + "*")),
-                       str(Path(conf.unified_agent_path, 'ws-ua_*')),
-                       str(Path(conf.unified_agent_path, 'WhiteSource-PlatformDependentFile_*')))
+    def list_folders(parent, prefixes):
+        try:
+            with os.scandir(parent) as entries:
+                return [entry.path for entry in entries if entry.name.startswith(prefixes)]
+        except OSError:
+            return []
+
+    # Grouped by parent folder , so each folder is listed once even when the conan install folder is the UA folder
+    prefixes_by_parent = defaultdict(tuple)
+    prefixes_by_parent[os.path.abspath(conf.conan_install_folder)] += (TEMP_FOLDER_PREFIX,)
+    prefixes_by_parent[os.path.abspath(conf.unified_agent_path)] += ('ws-ua_', 'WhiteSource-PlatformDependentFile_')
 
-    for pattern in prefix_patterns:
-        remove_folder(pattern)
+    folders = [item for parent, prefixes in prefixes_by_parent.items() for item in list_folders(parent, prefixes)]
+    if folders:
+        with ThreadPoolExecutor(max_workers=min(PROJECT_PARALLELISM_LEVEL_DEFAULT_VALUE, len(folders))) as executor:
+            list(executor.map(remove_folder, folders))
 
 
 def get_source_files_from_conan_main_package(config):
     if config.is_conanfilepy:
-        execute_command(f"conan source {config.project_path} --source-folder {config.temp_dir}", logger)
+        execute_command(['conan', 'source', config.project_path, '--source-folder', config.temp_dir], logger)
 
 
 def create_configuration() -> Config:
@@ -724,12 +895,22 @@ def main():
         dirs_to_scan.append(item)
 
     # Adding {'conandata_yml_download_url':url} dictionary for each conan package and aligning with ws index convention
-    conan_dependencies_new = update_conandta_yml_download_url_from_ws_index(config, conan_dependencies)
+    gc.disable()  # the bulk steps only create short lived dicts , reference counting is enough for them
+    try:
+        conan_dependencies_new = update_conandta_yml_download_url_from_ws_index(config, conan_dependencies)
+    finally:
+        gc.enable()
+        gc.collect()
 
     scan_with_unified_agent(config, dirs_to_scan)
 
     if config.change_origin_library:
-        change_project_source_file_inventory_match(config, conan_dependencies_new)
+        gc.disable()
+        try:
+            change_project_source_file_inventory_match(config, conan_dependencies_new)
+        finally:
+            gc.enable()
+            gc.collect()
 
     logger.info(f"Finished running {__description__}. Run time: {datetime.now() - start_time}")
 
@@ -746,5 +927,4 @@ def main():
 
 
 if __name__ == '__main__':
-    gc.collect()
     main()
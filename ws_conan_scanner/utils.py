@@ -1,42 +1,157 @@
 import argparse
 
 import csv
-import io
-import json
+import hashlib
+import logging
+import os
 import subprocess
+from pathlib import Path
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from ws_conan_scanner._version import __tool_name__
 
-def csv_to_json(csvFilePath):
-    r_bytes = requests.get(csvFilePath).content
-    r = r_bytes.decode('utf8')
-    reader = csv.DictReader(io.StringIO(r))
-    result_csv_reader = json.dumps(list(reader))
-    json_result = json.loads(result_csv_reader)
+CSV_CACHE_DIR = Path(Path.home(), '.cache', 'ws-conan-scanner')
+HTTP_TIMEOUT = 30
+CSV_CHUNK_SIZE = 1 << 16
+TRUE_STRINGS = frozenset({'yes', 'true', 't', 'y', '1'})  # compared with the lowered argument
+FALSE_STRINGS = frozenset({'no', 'false', 'f', 'n', '0'})
+
+logger = logging.getLogger(__tool_name__)
+
+
+def create_http_session():
+    """Session with a keep-alive connection pool , retrying transient gateway errors ( the last response is returned , not raised )"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16,
+                          max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+http_session = create_http_session()
+
+
+def iter_response_lines(r):
+    r"""Yields the decoded body line by line , keeping the line terminators.
+    Lines are split on '\n' only - csv needs the terminators for newlines inside quoted fields , which str.splitlines ( used by iter_lines ) drops along with other separators.
+    """
+    pending = ''
+    for chunk in r.iter_content(chunk_size=CSV_CHUNK_SIZE, decode_unicode=True):
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+def read_cache_file(path):
+    """Returns the parsed cache file , or None when it is missing or damaged ( e.g. by a run killed while writing it )"""
+    try:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+
+def write_cache_file(path, data):
+    """Writes to a temporary file which then replaces the cache file , so a killed run never leaves a truncated cache file"""
+    temp_path = Path(f"{path}.{os.getpid()}.tmp")
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(orjson.dumps(data))
+        os.replace(temp_path, path)
+    except OSError:
+        if temp_path.exists():
+            temp_path.unlink()
+        raise
+
+
+def cached_csv_to_json(csv_url, cache_dir=CSV_CACHE_DIR):
+    """Downloads the CSV rows as a list of dicts , keeps them on disk and revalidates them with a conditional GET (ETag / Last-Modified).
+    Falls back to the cached rows when the download fails , and to an empty list when nothing is cached either.
+    """
+    url_hash = hashlib.sha1(csv_url.encode('utf8')).hexdigest()
+    cache_file = Path(cache_dir, f"{url_hash}.json")
+    meta_file = Path(cache_dir, f"{url_hash}.meta")
+
+    headers = {}
+    meta = read_cache_file(meta_file)
+    cached_rows = read_cache_file(cache_file) if isinstance(meta, dict) else None
+    if cached_rows is not None:  # a damaged cache is a miss - without a conditional GET there is no 304 to answer with it
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    with http_session.get(csv_url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as r:
+        if cached_rows is not None and (r.status_code == 304 or not r.ok):
+            return cached_rows
+        if not r.ok:  # an error page is not an empty index , and must not be cached as one
+            logger.warning(f"Could not download {csv_url} ( HTTP {r.status_code} ) - continuing without it")
+            return []
+
+        r.encoding = 'utf8'  # text/csv without a charset would be decoded as ISO-8859-1
+        json_result = list(csv.DictReader(iter_response_lines(r)))  # rows are parsed while they are downloaded
+    try:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        write_cache_file(cache_file, json_result)  # the rows first - the meta file only ever describes rows that are complete on disk
+        write_cache_file(meta_file, {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')})
+    except OSError:
+        pass  # caching is best effort , the fresh result is still returned
     return json_result
 
 
 def str2bool(v):
     if isinstance(v, bool):
         return v
-    if v.lower() in ('yes', 'true', 'True', 't', 'y', '1'):
+    v = v.lower()
+    if v in TRUE_STRINGS:
         return True
-    elif v.lower() in ('no', 'false', 'False', 'f', 'n', '0'):
+    elif v in FALSE_STRINGS:
         return False
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
-def execute_command(command,logger):
+def command_to_argv(command) -> list:
+    if isinstance(command, str):  # would otherwise be run character by character
+        raise TypeError(f"The command must be an argv list , not a string: {command!r}")
+    return [str(arg) for arg in command]
 
+
+def execute_command_streaming(command):
+    """Runs the command ( an argv list , no shell ) and yields its combined stdout / stderr output line by line while it runs"""
+    command = command_to_argv(command)
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as process:
+        for line in process.stdout:
+            yield line.decode(errors='replace')
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def execute_command(command, logger, log_prefix=None):
+    """Runs the command ( an argv list , no shell ) and returns its combined stdout / stderr output.
+    The log_prefix ( e.g. the package name ) tells apart the output lines of commands running at the same time.
+    """
+    command = command_to_argv(command)
+    prefix = f"[{log_prefix}] " if log_prefix else ''
     try:
-        logger.info(f"Going to run the following command : {command}")
-        output = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT).decode()
-        logger.info(output)
-        return output
+        logger.info(f"{prefix}Going to run the following command : {' '.join(command)}")
+        output_lines = []
+        for line in execute_command_streaming(command):
+            logger.info(f"{prefix}{line.rstrip()}")
+            output_lines.append(line)
+        return ''.join(output_lines)
     except subprocess.CalledProcessError as e:
-        logger.error(e.output.decode())
+        logger.error(f"{prefix}{command[0]} exited with code {e.returncode}")
+    except OSError as e:
+        logger.error(f"{prefix}Failed to run {command[0]}: {e}")
 
 
 def create_logger(args):
@@ -48,6 +163,12 @@ def create_logger(args):
     from ws_conan_scanner.conan_scanner import DATE_TIME_NOW
     import os
 
+    # The format below only uses asctime , levelname and message - skip collecting the other record attributes
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    logging._srcfile = None  # no caller frame walk ( pathname / lineno / funcName ) per record
+
     logger = logging.getLogger(__tool_name__)
     logger.setLevel(logging.DEBUG if bool(os.environ.get("DEBUG", 0)) else logging.INFO)
 